@@ -3,7 +3,10 @@
 # Copyright (c) 2024 Phil Thompson <phil@riverbankcomputing.com>
 
 
+import functools
 import os
+import shutil
+import subprocess
 import sys
 
 from sipbuild import (Buildable, BuildableModule, Builder, Option, Project,
@@ -52,10 +55,17 @@ class QmakeBuilder(Builder):
                 raise PyProjectOptionException('qmake',
                         "'{0}' is not a working qmake".format(self.qmake))
 
-            self.qmake = self._quote(os.path.abspath(self.qmake))
+            qmake = os.path.abspath(self.qmake)
+            self.qmake = self._quote(qmake)
 
             # Use qmake to get the Qt configuration.
-            self._get_qt_configuration()
+            self._get_qt_configuration(qmake)
+
+            # By default (or if 0 was specified) run as many make jobs as there
+            # are CPUs unless the user is controlling make through the
+            # environment.
+            if not self.jobs and 'MAKEFLAGS' not in os.environ:
+                self.jobs = os.cpu_count()
 
             # Now apply defaults for any options that depend on the Qt
             # configuration.
@@ -154,19 +164,15 @@ class QmakeBuilder(Builder):
         pro_lines = []
 
         self._update_pro_file(pro_lines, buildable)
+        self._write_pro_file(pro_path, pro_lines)
 
-        pf = self.project.open_for_writing(pro_path)
-        pf.write('\n'.join(pro_lines))
-        pf.close()
+        if not self._run_qmake(pro_path, fatal=fatal):
+            return None
 
         saved_cwd = os.getcwd()
         os.chdir(buildable.build_dir)
 
-        if self._run_qmake(pro_path, fatal=fatal):
-            exe = self._run_make(buildable.target, buildable.debug,
-                    fatal=fatal)
-        else:
-            exe = None
+        exe = self._run_make(buildable.target, buildable.debug, fatal=fatal)
 
         os.chdir(saved_cwd)
 
@@ -201,9 +207,21 @@ class QmakeBuilder(Builder):
 
         pro_lines = []
 
+        # The generated modules don't depend on each other so, unless there
+        # are plain buildables (whose sub-directories may have their own .pro
+        # files with unknown dependencies), we don't specify 'ordered' so that
+        # make can build the sub-directories in parallel.
+        ordered = any(type(buildable) is Buildable
+                for buildable in project.buildables)
+
         pro_lines.append('TEMPLATE = subdirs')
-        pro_lines.append('CONFIG += ordered nostrip')
-        pro_lines.append('SUBDIRS = {}'.format(' '.join(subdirs)))
+
+        if ordered:
+            pro_lines.append('CONFIG += ordered nostrip')
+        else:
+            pro_lines.append('CONFIG += nostrip')
+
+        pro_lines.append(f"SUBDIRS = {' '.join(subdirs)}")
 
         # Add any project-level installables.
         for installable in project.installables:
@@ -212,12 +230,8 @@ class QmakeBuilder(Builder):
         # Make the .dist-info directory if required.
         if project.distinfo:
             inventory_fn = os.path.join(project.build_dir, 'inventory.txt')
-            inventory = project.open_for_writing(inventory_fn)
-
-            for fn in installed:
-                print(fn, file=inventory)
-
-            inventory.close()
+            self._write_file(inventory_fn,
+                    ''.join([fn + '\n' for fn in installed]))
 
             args = project.get_sip_distinfo_command_line(self._sip_distinfo,
                     inventory_fn, generator='pyqtbuild',
@@ -225,32 +239,34 @@ class QmakeBuilder(Builder):
                     wheel_tag=wheel_tag)
             args.append(self.qmake_quote(project.get_distinfo_dir(target_dir)))
 
-            pro_lines.append('distinfo.depends = install_subtargets {}'.format(
-                    ' '.join(
-                            ['install_' + installable.name
-                                    for installable in project.installables])))
-            pro_lines.append('distinfo.extra = {}'.format(' '.join(args)))
+            depends = ' '.join(['install_' + installable.name
+                    for installable in project.installables])
+
             pro_lines.append(
-                    'distinfo.path = {}'.format(self.qmake_quote(target_dir)))
+                    f'distinfo.depends = install_subtargets {depends}')
+            pro_lines.append(f"distinfo.extra = {' '.join(args)}")
+            pro_lines.append(
+                    f'distinfo.path = {self.qmake_quote(target_dir)}')
             pro_lines.append('INSTALLS += distinfo')
 
         pro_name = os.path.join(project.build_dir, project.name + '.pro')
         self._write_pro_file(pro_name, pro_lines)
 
-        # Run qmake to generate the Makefiles.
+        # Run qmake to generate the top-level Makefile.  The Makefiles in each
+        # sub-directory will be generated by make (and so in parallel) as they
+        # are needed.
         project.progress("Generating the Makefiles")
 
-        saved_cwd = os.getcwd()
-        os.chdir(project.build_dir)
-
-        self._run_qmake(pro_name, recursive=True)
+        self._run_qmake(pro_name)
 
         # Run make, if requested, to generate the bindings.
         if self.make:
             project.progress("Compiling the project")
-            self._run_project_make()
 
-        os.chdir(saved_cwd)
+            saved_cwd = os.getcwd()
+            os.chdir(project.build_dir)
+            self._run_project_make()
+            os.chdir(saved_cwd)
 
         return None
 
@@ -304,7 +320,7 @@ class QmakeBuilder(Builder):
         path = path.replace('\\', '/')
 
         if ' ' in path:
-            path = '$$quote({})'.format(path)
+            path = f'$$quote({path})'
 
         return path
 
@@ -312,16 +328,17 @@ class QmakeBuilder(Builder):
     def _find_exe(cls, exe):
         """ Find an executable, ie. the first on the path. """
 
-        if sys.platform == 'win32':
-            exe += '.exe'
+        return cls._find_exe_on_path(exe, os.environ.get('PATH', ''))
 
-        for d in os.environ.get('PATH', '').split(os.pathsep):
-            exe_path = os.path.join(d, exe)
-
-            if cls._is_exe(exe_path):
-                return exe_path
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _find_exe_on_path(exe, path):
+        """ Find an executable on a path.  The result is cached as the path
+        is searched several times during a build.
+        """
 
-        return None
+        # Note that this handles PATHEXT on Windows.
+        return shutil.which(exe, path=path)
 
     def _find_make(self):
         """ Return the name of a valid make program. """
@@ -329,6 +346,10 @@ class QmakeBuilder(Builder):
         if self.project.py_platform == 'win32':
             if 'g++' in self.spec:
                 make = 'make'
+            elif self._find_exe('jom') is not None:
+                # jom is a drop-in replacement for nmake that supports
+                # parallel jobs.
+                make = 'jom'
             else:
                 make = 'nmake'
         else:
@@ -374,9 +395,8 @@ class QmakeBuilder(Builder):
         pro_lines.append('CONFIG -= android_install')
 
         if project.android_abis:
-            pro_lines.append(
-                    'ANDROID_ABIS = "{}"'.format(
-                            ' '.join(project.android_abis)))
+            abis = ' '.join(project.android_abis)
+            pro_lines.append(f'ANDROID_ABIS = "{abis}"')
 
         self._update_pro_file(pro_lines, buildable)
 
@@ -418,7 +438,7 @@ target.CONFIG = no_check_exist
 target.files = %s
 ''' % (module, module)
 
-            pro_lines.extend(shared.split('\n'))
+            pro_lines.append(shared)
 
         buildable.installables.append(
                 QmakeTargetInstallable(module, buildable.get_install_subdir()))
@@ -435,32 +455,28 @@ macx {
 }
 ''' % (project.target_qt_dir, project.target_qt_dir)
 
-            pro_lines.extend(rpath.split('\n'))
+            pro_lines.append(rpath)
 
         # This optimisation could apply to other platforms.
         if 'linux' in self.spec and not buildable.static:
-            exp = project.open_for_writing(
+            self._write_file(
                     os.path.join(buildable.build_dir,
-                            buildable.target + '.exp'))
-            exp.write('{ global: PyInit_%s; local: *; };' % buildable.target)
-            exp.close()
+                            buildable.target + '.exp'),
+                    '{ global: PyInit_%s; local: *; };' % buildable.target)
 
             pro_lines.append(
-                    'QMAKE_LFLAGS += -Wl,--version-script={}.exp'.format(
-                            buildable.target))
+                    'QMAKE_LFLAGS += '
+                    f'-Wl,--version-script={buildable.target}.exp')
 
         pro_lines.append(
-                'INCLUDEPATH += {}'.format(
-                        self.qmake_quote(project.py_include_dir)))
+                f'INCLUDEPATH += {self.qmake_quote(project.py_include_dir)}')
 
         # Python.h on Windows seems to embed the need for pythonXY.lib, so tell
         # it where it is.
         # TODO: is this still necessary for Python v3.8?
         if not buildable.static:
-            pro_lines.extend(['win32 {',
-                    '    LIBS += -L{}'.format(
-                            self.qmake_quote(project.py_pylib_dir)),
-                    '}'])
+            pylib_dir = self.qmake_quote(project.py_pylib_dir)
+            pro_lines.extend(['win32 {', f'    LIBS += -L{pylib_dir}', '}'])
 
         # Add any installables from the buildable.
         for installable in buildable.installables:
@@ -471,42 +487,72 @@ macx {
                 os.path.join(buildable.build_dir, buildable.name + '.pro'),
                 pro_lines)
 
-    def _get_qt_configuration(self):
-        """ Run qmake to get the details of the Qt configuration. """
+    def _get_make_command(self):
+        """ Return the command line arguments to run make including any
+        arguments to run jobs in parallel.
+        """
+
+        make = self._find_make()
+        args = [make]
+
+        # nmake doesn't support parallel jobs.
+        if make != 'nmake' and self.jobs:
+            args.append('-j')
+            args.append(str(self.jobs))
+
+        return args
+
+    def _get_qt_configuration(self, qmake):
+        """ Run qmake to get the details of the Qt configuration.  qmake is
+        the unquoted pathname of the qmake executable.
+        """
 
         project = self.project
 
         project.progress("Querying qmake about your Qt installation")
 
+        # Capture all the output in one go rather than reading it a line at a
+        # time through a shell.
+        args = [qmake, '-query']
+
+        if project.verbose:
+            print(' '.join(args), flush=True)
+
+        try:
+            query = subprocess.run(args, stdin=subprocess.DEVNULL,
+                    capture_output=True, text=True, errors='ignore')
+        except OSError as e:
+            raise UserException("Unable to run '{0}'".format(qmake),
+                    detail=str(e))
+
+        if query.returncode != 0:
+            raise UserException(
+                    "'{0}' failed returning {1}".format(' '.join(args),
+                            query.returncode),
+                    detail=query.stderr)
+
         self.qt_configuration = {}
 
-        for line in project.read_command_pipe([self.qmake, '-query']):
+        for line in query.stdout.splitlines():
             line = line.strip()
 
-            tokens = line.split(':', maxsplit=1)
-            if isinstance(tokens, list):
-                if len(tokens) != 2:
-                    raise UserException(
-                            "Unexpected output from qmake: '{0}'".format(line))
-
-                name, value = tokens
-            else:
-                name = tokens
-                value = None
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise UserException(
+                        "Unexpected output from qmake: '{0}'".format(line))
 
-            name = name.replace('/', '_')
+            self.qt_configuration[name.replace('/', '_')] = value
 
-            self.qt_configuration[name] = value
+        # Get the Qt version.  The qmake from Qt v3 doesn't provide it.
+        self.qt_version_str = self.qt_configuration.get('QT_VERSION', '3')
 
-        # Get the Qt version.
-        self.qt_version = 0
         try:
-            self.qt_version_str = self.qt_configuration['QT_VERSION']
-            for v in self.qt_version_str.split('.'):
-                self.qt_version <<= 8
-                self.qt_version += int(v)
-        except AttributeError:
-            self.qt_version_str = "3"
+            version = [int(v) for v in self.qt_version_str.split('.')]
+        except ValueError:
+            version = []
+
+        major, minor, patch = (version + [0, 0, 0])[:3]
+        self.qt_version = (major << 16) | (minor << 8) | patch
 
         # Requiring Qt v5.6 allows us to drop some old workarounds.
         if self.qt_version < 0x050600:
@@ -514,12 +560,8 @@ macx {
                     "Qt v5.6 or later is required and you seem to be using "
                             "v{0}".format(self.qt_version_str))
 
-        # Convert the version number to what would be used in a tag.
-        major = (self.qt_version >> 16) & 0xff
-        minor = (self.qt_version >> 8) & 0xff
-        patch = self.qt_version & 0xff
-
-        # Qt v5.12.4 was the last release where we updated for a patch version.
+        # Convert the version number to what would be used in a tag.  Qt
+        # v5.12.4 was the last release where we updated for a patch version.
         # This should be safe to do (given Qt's supposed use of semantic
         # versioning) and removes the need to add new patch versions for old
         # (ie. LTS) versions.  However Qt v5.15 breaks semantic versioning so
@@ -539,17 +581,16 @@ macx {
 
         installable.install(target_dir, installed, do_install=False)
 
-        pro_lines.append(
-                '{}.path = {}'.format(installable.name,
-                        installable.get_full_target_dir(target_dir).replace(
-                                '\\', '/')))
+        name = installable.name
+        path = installable.get_full_target_dir(target_dir).replace('\\', '/')
+
+        pro_lines.append(f'{name}.path = {path}')
 
         if not isinstance(installable, QmakeTargetInstallable):
             files = [fn.replace('\\', '/') for fn in installable.files]
-            pro_lines.append(
-                    '{}.files = {}'.format(installable.name, ' '.join(files)))
+            pro_lines.append(f"{name}.files = {' '.join(files)}")
 
-        pro_lines.append('INSTALLS += {}'.format(installable.name))
+        pro_lines.append(f'INSTALLS += {name}')
 
     @staticmethod
     def _is_exe(exe_path):
@@ -604,7 +645,7 @@ macx {
         # Make sure the executable doesn't exist.
         self._remove_file(platform_exe)
 
-        args = [self._find_make()]
+        args = self._get_make_command()
 
         if makefile_target is not None:
             args.append(makefile_target)
@@ -618,26 +659,21 @@ macx {
         directory.
         """
 
-        project = self.project
-
-        args = [self._find_make()]
-
         if install:
-            args.append('install')
-        elif project.py_platform != 'win32' and self.jobs:
-            args.append('-j')
-            args.append(str(self.jobs))
+            args = [self._find_make(), 'install']
+        else:
+            args = self._get_make_command()
 
-        project.run_command(args)
+        self.project.run_command(args)
 
-    def _run_qmake(self, pro_name, fatal=True, recursive=False):
+    def _run_qmake(self, pro_name, fatal=True):
         """ Run qmake against a .pro file.  fatal is set if a qmake failure is
         considered a fatal error, otherwise False is returned if qmake fails.
-        The current directory must contain the .pro file.
+        The Makefile is created in the same directory as the .pro file.
         """
 
         # Make sure the Makefile doesn't exist.
-        mf_name = 'Makefile'
+        mf_name = os.path.join(os.path.dirname(pro_name), 'Makefile')
         self._remove_file(mf_name)
 
         # Build the command line.
@@ -649,10 +685,12 @@ macx {
             args.append('-spec')
             args.append(self.spec)
 
-        if recursive:
-            args.append('-recursive')
+        # Name the Makefile explicitly so that qmake doesn't depend on the
+        # current directory.
+        args.append('-o')
+        args.append(self._quote(mf_name))
 
-        args.append(os.path.basename(pro_name))
+        args.append(self._quote(pro_name))
 
         self.project.run_command(args, fatal=fatal)
 
@@ -677,8 +715,7 @@ macx {
 
         # Handle debugging.
         pro_lines.append(
-                'CONFIG += {}'.format(
-                        'debug' if buildable.debug else 'release'))
+                f"CONFIG += {'debug' if buildable.debug else 'release'}")
 
         # Add any buildable-specific settings.
         pro_lines.extend(buildable.builder_settings)
@@ -687,55 +724,54 @@ macx {
         pro_lines.extend(self.qmake_settings)
 
         # Add the target.
-        pro_lines.append('TARGET = {}'.format(buildable.target))
+        pro_lines.append(f'TARGET = {buildable.target}')
 
         # Handle any #define macros.
         if buildable.define_macros:
-            pro_lines.append('DEFINES += {}'.format(
-                    ' '.join(buildable.define_macros)))
+            pro_lines.append(f"DEFINES += {' '.join(buildable.define_macros)}")
 
         # Handle the include directories.
         for include_dir in buildable.include_dirs:
-            pro_lines.append(
-                    'INCLUDEPATH += {}'.format(self.qmake_quote(include_dir)))
+            pro_lines.append(f'INCLUDEPATH += {self.qmake_quote(include_dir)}')
 
         # Handle any additional libraries.
         libs = []
 
-        for l_dir in buildable.library_dirs:
-            libs.append('-L' + self.qmake_quote(l_dir))
+        libs.extend(['-L' + self.qmake_quote(l_dir)
+                for l_dir in buildable.library_dirs])
 
-        for l in buildable.libraries:
-            libs.append('-l' + l)
+        libs.extend(['-l' + l for l in buildable.libraries])
 
         if libs:
-            pro_lines.append('LIBS += {}'.format(' '.join(libs)))
+            pro_lines.append(f"LIBS += {' '.join(libs)}")
 
-        headers = [self.qmake_quote(f) for f in buildable.headers]
-        pro_lines.append('HEADERS = {}'.format(' '.join(headers)))
+        headers = ' '.join(map(self.qmake_quote, buildable.headers))
+        pro_lines.append(f'HEADERS = {headers}')
 
-        sources = [self.qmake_quote(f) for f in buildable.sources]
-        pro_lines.append('SOURCES = {}'.format(' '.join(sources)))
+        sources = ' '.join(map(self.qmake_quote, buildable.sources))
+        pro_lines.append(f'SOURCES = {sources}')
 
         # Add any extras.
         if buildable.extra_compile_args:
-            pro_lines.append(
-                    'QMAKE_CXXFLAGS += {}'.format(
-                            ' '.join(buildable.extra_compile_args)))
+            cxxflags = ' '.join(buildable.extra_compile_args)
+            pro_lines.append(f'QMAKE_CXXFLAGS += {cxxflags}')
 
         if buildable.extra_link_args:
-            pro_lines.append(
-                    'QMAKE_LFLAGS += {}'.format(
-                            ' '.join(buildable.extra_link_args)))
+            lflags = ' '.join(buildable.extra_link_args)
+            pro_lines.append(f'QMAKE_LFLAGS += {lflags}')
 
         if buildable.extra_objects:
-            objects = [self.qmake_quote(f) for f in buildable.objects]
-            pro_lines.append('OBJECTS += {}'.format(' '.join(objects)))
+            objects = ' '.join(map(self.qmake_quote, buildable.extra_objects))
+            pro_lines.append(f'OBJECTS += {objects}')
+
+    def _write_file(self, fname, text):
+        """ Write some text to a file in one go. """
+
+        f = self.project.open_for_writing(fname)
+        f.write(text)
+        f.close()
 
     def _write_pro_file(self, pro_fn, pro_lines):
         """ Write a .pro file. """
 
-        pro = self.project.open_for_writing(pro_fn)
-        pro.write('\n'.join(pro_lines))
-        pro.write('\n')
-        pro.close()
+        self._write_file(pro_fn, '\n'.join(pro_lines) + '\n')